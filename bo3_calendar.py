@@ -1,16 +1,23 @@
-import os, re, json, time
+import os, re, json, time, functools, random, base64, hashlib
+from dataclasses import dataclass
 from datetime import datetime, timedelta, date
-import pytz
+from zoneinfo import ZoneInfo
 
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.service_account import Credentials
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 
 # ========== CONFIG ==========
 BO3_URL = "https://bo3.gg/teams/natus-vincere/matches"
 TIMEZONE = "Europe/Kyiv"
 CALENDAR_ID = (os.environ.get("CALENDAR_ID") or "").strip() or "primary"
 EVENT_DURATION_HOURS = 2
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}  # для читання .table-row не потрібні
+BATCH_SIZE = 50  # ліміт Calendar API на кількість підзапитів в одному batch
+RETRY_STATUSES = {403, 429, 500, 503}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}  # 403 з іншою причиною — це відсутність доступу
+RETRY_ATTEMPTS = 5
 
 # Фільтри часу
 LOOKAHEAD_DAYS = int(os.environ.get("LOOKAHEAD_DAYS", "60"))          # події не далі цього горизонту
@@ -23,36 +30,70 @@ MONTHS = {
     "september":9,"october":10,"november":11,"december":12
 }
 
-TZ_LOCAL = pytz.timezone(TIMEZONE)
-
-def _infer_year_from_href(href: str, month: int, day: int) -> int:
-    m = re.search(r"(\d{2})-(\d{2})-(\d{4})$", href or "")
+TZ_LOCAL = ZoneInfo(TIMEZONE)
+
+@dataclass(slots=True)
+class Match:
+    summary: str
+    summary_main: str      # «Team A vs Team B» — за цим шукаємо дублікати в календарі
+    start_local: datetime
+    end_local: datetime
+    link: str
+
+# шаблони компілюємо з re.ASCII; під re.A \s не ловить NBSP, тому текст перед пошуком нормалізуємо через " ".join(split())
+_HREF_YEAR_RE = re.compile(r"\d{2}-\d{2}-(\d{4})$", re.A)  # хвіст посилання на матч: ...-DD-MM-YYYY
+_MONTH_DAY_PREFIX_RE = re.compile(r"([A-Za-z]+)\s+(\d{1,2})", re.A)
+_BO_RE = re.compile(r"Bo\d", re.I | re.A)
+# один прохід по тексту рядка замість окремих пошуків часу й дати; назву місяця перевіряємо через MONTHS
+# після дня не вимагаємо межі слова, щоб «Oct 15th» теж давало дату; (?![\d:]) лише не дає відкусити «Oct 1» з «Oct 18:00»
+_TIME_OR_DATE_RE = re.compile(r'(?P<time>\b\d{1,2}:\d{2}\b)|(?P<mon>\b[A-Za-z]+)\s+(?P<day>\d{1,2})(?![\d:])', re.A)
+
+# Усі поля рядків матчів за один виклик у браузері, а не по кілька locator-запитів на кожен рядок.
+# Скрізь innerText, як і раніше: textContent підхопив би приховані адаптивні підписи й сирі пробіли,
+# а назви команд ідуть у перевірку дублікатів та id події.
+_ROW_EXTRACT_JS = """
+rows => rows.map(r => {
+    const text = sel => { const el = r.querySelector(sel); return el ? (el.innerText || "").trim() : ""; };
+    const link = r.querySelector('a[href*="/matches/"]');
+    const dateEl = r.querySelector(".date");
+    return {
+        href: link ? (link.getAttribute("href") || "") : "",
+        teams: Array.from(r.querySelectorAll(".team-name"), el => (el.innerText || "").trim()),
+        bo: text(".bo-type"),
+        tournament: text(".tournament-name"),
+        time: text(".date .time"),
+        date: dateEl ? dateEl.innerText : "",
+        raw: r.innerText,
+    };
+})
+"""
+
+def _infer_year_from_href(href: str, month: int, day: int, today: date) -> int:
+    m = _HREF_YEAR_RE.search(href or "")
     if m:
-        return int(m.group(3))
-    today = datetime.now(TZ_LOCAL).date()
+        return int(m.group(1))
     cand = date(today.year, month, day)
     return today.year if cand >= today else today.year + 1
 
+def _iso_naive(dt: datetime) -> str:
+    # те саме, що dt.strftime("%Y-%m-%dT%H:%M:%S"), але без локалізованого strftime
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+
+@functools.lru_cache(maxsize=64)
 def _norm_month_day(text: str):
     if not text: return None
-    t = re.sub(r"\s+", " ", text.replace(".", " ")).strip()
-    m = re.match(r"([A-Za-z]+)\s+(\d{1,2})", t)
+    t = " ".join(text.replace(".", " ").split())
+    m = _MONTH_DAY_PREFIX_RE.match(t)
     if not m: return None
     mon = m.group(1).lower()
     day = int(m.group(2))
     if mon not in MONTHS: return None
     return MONTHS[mon], day
 
-def scrape_matches():
+def _render_rows():
     """
-    Відкриваємо сторінку у Chromium (headless), чекаємо рендеру й дістаємо матчі з DOM.
-    Повертаємо ТІЛЬКИ сьогоднішні/майбутні (з урахуванням PAST_GRACE_MINUTES).
+    Відкриваємо сторінку у Chromium (headless), чекаємо рендеру й дістаємо сирі поля рядків з DOM.
     """
-    out = []
-    now_local = datetime.now(TZ_LOCAL)
-    horizon = now_local + timedelta(days=LOOKAHEAD_DAYS)
-    grace_cutoff = now_local - timedelta(minutes=PAST_GRACE_MINUTES)
-
     with sync_playwright() as pw:
         browser = pw.chromium.launch(headless=True)
         context = browser.new_context(
@@ -61,146 +102,267 @@ def scrape_matches():
             user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0 Safari/537.36",
             viewport={"width": 1366, "height": 900},
         )
+        context.route("**/*", lambda route: route.abort()
+                      if route.request.resource_type in BLOCKED_RESOURCE_TYPES else route.continue_())
         page = context.new_page()
-        page.set_default_timeout(30000)
 
         page.goto(BO3_URL, wait_until="domcontentloaded")
-        page.wait_for_timeout(1500)
-        for _ in range(5):
-            if page.locator(".table-row").count() > 0:
-                break
-            page.wait_for_timeout(800)
-
-        rows = page.locator(".table-row")
-        count = rows.count()
-        print(f"[INFO] Rendered rows: {count}")
-
-        for i in range(count):
-            row = rows.nth(i)
-
-            # посилання на матч
-            link_el = row.locator('a[href*="/matches/"]').first
-            href = ""
-            try:
-                href = link_el.get_attribute("href") or ""
-            except:
-                href = ""
-            match_link = ("https://bo3.gg" + href) if href else BO3_URL
-
-            # команди
-            team_names = row.locator(".team-name")
-            tcount = team_names.count()
-            team1 = team_names.nth(0).inner_text().strip() if tcount >= 1 else ""
-            team2 = team_names.nth(1).inner_text().strip() if tcount >= 2 else "TBD"
-
-            # формат (Bo3)
-            bo = ""
-            try:
-                bo_text = row.locator(".bo-type").first.inner_text().strip()
-                if re.match(r"Bo\d", bo_text, flags=re.I):
-                    bo = bo_text
-            except:
-                pass
-
-            # турнір
-            tournament = ""
-            try:
-                tournament = row.locator(".tournament-name").first.inner_text().strip()
-            except:
-                pass
-
-            # час/дата
-            time_text = ""
-            date_text = ""
-            try:
-                time_text = row.locator(".date .time").first.inner_text().strip()
-            except:
-                pass
-            try:
-                date_block = row.locator(".date").first.inner_text()
-                if date_block:
-                    date_text = date_block.replace(time_text, "").strip()
-            except:
-                pass
-
-            if not (time_text and date_text):
-                raw = row.inner_text().strip()
-                mt = re.search(r'\b(\d{1,2}:\d{2})\b', raw)
-                md = re.search(r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December)\s+\d{1,2}', raw, re.I)
-                if mt and md:
-                    time_text = mt.group(1)
-                    date_text = md.group(0)
-
-            if not (time_text and date_text):
-                continue
-
-            md = _norm_month_day(date_text)
-            if not md:
-                continue
-            mon, day = md
-
-            try:
-                hh, mm = [int(x) for x in time_text.split(":")]
-            except:
-                continue
-
-            year = _infer_year_from_href(href, mon, day)
-            start_local = TZ_LOCAL.localize(datetime(year, mon, day, hh, mm))
-            end_local = start_local + timedelta(hours=EVENT_DURATION_HOURS)
-
-            # === ФІЛЬТР ЧАСУ: тільки сьогодні/майбутні (з грейсом) ===
-            if start_local < grace_cutoff:
-                # старіше ніж дозволений грейс — скіпаємо
-                continue
-            if start_local > horizon:
-                # занадто далеко в майбутньому — скіпаємо
-                continue
-
-            summary = f"{team1} vs {team2}" + (f" ({bo})" if bo else "")
-            if tournament:
-                summary += f" — {tournament}"
-
-            out.append({
-                "summary": summary,
-                "start_dt_str": start_local.strftime("%Y-%m-%dT%H:%M:%S"),
-                "end_dt_str": end_local.strftime("%Y-%m-%dT%H:%M:%S"),
-                "link": match_link,
-            })
+        # чекаємо саме появи рядків, а не фіксовану паузу
+        try:
+            page.wait_for_selector(".table-row", state="attached", timeout=15000)
+        except PlaywrightTimeoutError:
+            print("[WARN] No .table-row rendered within 15s")
+
+        raw_rows = page.locator(".table-row").evaluate_all(_ROW_EXTRACT_JS)
+        print(f"[INFO] Rendered rows: {len(raw_rows)}")
 
         context.close()
         browser.close()
+    return raw_rows
+
+def scrape_matches():
+    """
+    Дістаємо матчі зі сторінки й розбираємо рядки.
+    Повертаємо ТІЛЬКИ сьогоднішні/майбутні (з урахуванням PAST_GRACE_MINUTES).
+    """
+    out = []
+    seen = set()
+    now_local = datetime.now(TZ_LOCAL)
+    today = now_local.date()
+    horizon = now_local + timedelta(days=LOOKAHEAD_DAYS)
+    grace_cutoff = now_local - timedelta(minutes=PAST_GRACE_MINUTES)
+
+    for r in _render_rows():
+        # посилання на матч
+        href = r["href"]
+        match_link = ("https://bo3.gg" + href) if href else BO3_URL
+
+        # команди
+        teams = r["teams"]
+        team1 = teams[0] if len(teams) >= 1 else ""
+        team2 = teams[1] if len(teams) >= 2 else "TBD"
+
+        # формат (Bo3)
+        bo = r["bo"] if _BO_RE.match(r["bo"]) else ""
+
+        # турнір
+        tournament = r["tournament"]
+
+        # час/дата
+        time_text = r["time"]
+        date_text = r["date"].replace(time_text, "").strip()
+
+        if not (time_text and date_text):
+            raw = " ".join(r["raw"].split())  # зокрема NBSP між місяцем і днем
+            mt = md = ""
+            for tok in _TIME_OR_DATE_RE.finditer(raw):
+                if tok.lastgroup == "time":
+                    mt = mt or tok.group("time")
+                elif tok.group("mon").lower() in MONTHS:
+                    md = md or tok.group(0)
+                if mt and md:
+                    break
+            if mt and md:
+                time_text = mt
+                date_text = md
+
+        if not (time_text and date_text):
+            continue
+
+        md = _norm_month_day(date_text)
+        if not md:
+            continue
+        mon, day = md
+
+        try:
+            hh, mm = [int(x) for x in time_text.split(":")]
+        except:
+            continue
+
+        year = _infer_year_from_href(href, mon, day, today)
+        start_local = datetime(year, mon, day, hh, mm, tzinfo=TZ_LOCAL)
+        end_local = start_local + timedelta(hours=EVENT_DURATION_HOURS)
+
+        # === ФІЛЬТР ЧАСУ: тільки сьогодні/майбутні (з грейсом) ===
+        if start_local < grace_cutoff:
+            # старіше ніж дозволений грейс — скіпаємо
+            continue
+        if start_local > horizon:
+            # занадто далеко в майбутньому — скіпаємо
+            continue
+
+        summary_main = f"{team1} vs {team2}"
+        summary = summary_main + (f" ({bo})" if bo else "")
+        if tournament:
+            summary += f" — {tournament}"
+
+        # той самий матч може бути у DOM двічі — не витрачаємо на нього зайвих запитів до календаря
+        key = (summary_main.lower(), start_local)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        out.append(Match(
+            summary=summary,
+            summary_main=summary_main,
+            start_local=start_local,
+            end_local=end_local,
+            link=match_link,
+        ))
     return out
 
-def has_duplicate_event(service, calendar_id, start_dt, summary):
-    time_min = (start_dt - timedelta(hours=3)).isoformat()
-    time_max = (start_dt + timedelta(hours=3)).isoformat()
-    items = service.events().list(
-        calendarId=calendar_id, timeMin=time_min, timeMax=time_max,
-        singleEvents=True, orderBy="startTime",
-        q=" vs ".join(summary.split(" vs ")[:2])
-    ).execute().get("items", [])
+def _is_retryable(e: HttpError) -> bool:
+    status = e.resp.status
+    if status not in RETRY_STATUSES:
+        return False
+    if status != 403:
+        return True
+    try:
+        errors = json.loads(e.content)["error"]["errors"]
+        return any(err.get("reason") in RATE_LIMIT_REASONS for err in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+def _execute_with_backoff(request, on_retry=None):
+    """
+    request.execute() з експоненційним backoff на rate limit і тимчасові помилки Google API.
+    403 повторюємо лише для rateLimitExceeded/userRateLimitExceeded, а не для відсутності доступу.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if not _is_retryable(e) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            print(f"[WARN] Calendar API HTTP {e.resp.status}, retry in {delay:.1f}s")
+            if on_retry:
+                on_retry()
+            time.sleep(delay)
+
+def load_existing_events(service, calendar_id, time_min, time_max):
+    """
+    Один запит events().list на все вікно матчів замість окремого запиту на кожен матч.
+    Повертаємо список (start_dt, end_dt, summary) для локальної перевірки дублікатів.
+    """
+    items = []
+    page_token = None
+    while True:
+        resp = _execute_with_backoff(service.events().list(
+            calendarId=calendar_id, timeMin=time_min.isoformat(), timeMax=time_max.isoformat(),
+            singleEvents=True, maxResults=2500, pageToken=page_token,
+            fields="items(summary,start(dateTime,date),end(dateTime,date)),nextPageToken",
+        ))
+        items.extend(resp.get("items", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            break
+    def _parse(t):
+        raw = t.get("dateTime") or t.get("date")
+        if not raw:
+            return None
+        dt = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+        return dt if dt.tzinfo else dt.replace(tzinfo=TZ_LOCAL)
+
+    index = []
     for ev in items:
-        if ev.get("summary","").startswith(" vs ".join(summary.split(" vs ")[:2])):
-            print(f"[SKIP] Duplicate around: {ev.get('summary')} at {ev.get('start',{}).get('dateTime')}")
+        start_dt = _parse(ev.get("start", {}))
+        if start_dt is None:
+            continue
+        end_dt = _parse(ev.get("end", {})) or start_dt
+        index.append((start_dt, end_dt, ev.get("summary", "")))
+    return index
+
+def has_duplicate_event_local(index, summary_main, start_dt):
+    # як і events().list з timeMin/timeMax: рахується будь-яка подія, що перетинає вікно ±3 год
+    win_min, win_max = start_dt - timedelta(hours=3), start_dt + timedelta(hours=3)
+    for ev_start, ev_end, ev_summary in index:
+        if ev_start < win_max and ev_end > win_min and ev_summary.startswith(summary_main):
+            print(f"[SKIP] Duplicate around: {ev_summary} at {ev_start.isoformat()}")
             return True
     return False
 
+def _event_id(m: Match) -> str:
+    # детермінований id (base32hex, як вимагає Calendar API): якщо insert уже записався, а відповідь загубилась,
+    # повторна спроба отримає 409 замість другої події
+    key = f"{m.summary_main.lower()}|{m.start_local.isoformat()}"
+    return base64.b32hexencode(hashlib.sha1(key.encode()).digest()).decode().rstrip("=").lower()
+
 def create_events(service, matches):
-    created = 0
+    index = load_existing_events(
+        service, CALENDAR_ID,
+        min(m.start_local for m in matches) - timedelta(hours=3),
+        max(m.start_local for m in matches) + timedelta(hours=3),
+    )
+    pending = []
     for m in matches:
-        start_dt = TZ_LOCAL.localize(datetime.strptime(m["start_dt_str"], "%Y-%m-%dT%H:%M:%S"))
-        if has_duplicate_event(service, CALENDAR_ID, start_dt, m["summary"]):
+        if has_duplicate_event_local(index, m.summary_main, m.start_local):
             continue
         event = {
-            "summary": m["summary"],
-            "description": f"Auto-added from {BO3_URL}\nMatch page: {m['link']}",
-            "start": {"dateTime": m["start_dt_str"], "timeZone": TIMEZONE},
-            "end":   {"dateTime": m["end_dt_str"],   "timeZone": TIMEZONE},
+            "id": _event_id(m),
+            "summary": m.summary,
+            "description": f"Auto-added from {BO3_URL}\nMatch page: {m.link}",
+            "start": {"dateTime": _iso_naive(m.start_local), "timeZone": TIMEZONE},
+            "end":   {"dateTime": _iso_naive(m.end_local),   "timeZone": TIMEZONE},
         }
         print("[DEBUG] Prepared event:", event)
-        res = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
-        print(f"[CREATED] {m['summary']} → {res.get('htmlLink','')}")
+        pending.append((m, event))
+        index.append((m.start_local, m.end_local, m.summary))
+
+    created = 0
+    failed = []
+    errors = []  # помилки, що лишились після всіх спроб: після обробки решти подій валимо запуск
+    def _on_insert(request_id, response, exception):
+        nonlocal created
+        i = int(request_id)
+        if exception is not None:
+            if isinstance(exception, HttpError) and exception.resp.status == 409 and replayed:
+                print(f"[CREATED] {pending[i][0].summary} (already stored by an earlier attempt)")
+                created += 1
+            elif isinstance(exception, HttpError) and exception.resp.status == 409:
+                # подія з таким id уже є (наприклад, видалена вручну) — не створюємо її повторно
+                print(f"[SKIP] Event id already exists: {pending[i][0].summary}")
+            elif isinstance(exception, HttpError) and _is_retryable(exception):
+                print(f"[WARN] Batch insert failed for {pending[i][0].summary}: {exception}")
+                failed.append(i)
+            else:
+                print(f"[ERROR] Insert failed for {pending[i][0].summary}: {exception}")
+                errors.append(pending[i][0].summary)
+            return
+        print(f"[CREATED] {pending[i][0].summary} → {response.get('htmlLink','')}")
+        created += 1
+
+    # усі вставки йдуть batch-запитами (до BATCH_SIZE підзапитів за один HTTP round trip)
+    for offset in range(0, len(pending), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_on_insert)
+        for i in range(offset, min(offset + BATCH_SIZE, len(pending))):
+            batch.add(service.events().insert(calendarId=CALENDAR_ID, body=pending[i][1]), request_id=str(i))
+        # сам multipart-запит теж може отримати 429/5xx; повтор безпечний, бо підзапити мають фіксовані id
+        replayed = False  # true, якщо batch уже надсилався: тоді 409 означає, що подію записала попередня спроба
+        def _mark_replayed():
+            nonlocal replayed
+            replayed = True
+        _execute_with_backoff(batch, on_retry=_mark_replayed)
+
+    # підзапити, що впали в batch з тимчасовою помилкою, пробуємо ще раз поодинці
+    for i in failed:
+        m, event = pending[i]
+        try:
+            res = _execute_with_backoff(service.events().insert(calendarId=CALENDAR_ID, body=event))
+        except Exception as e:
+            # 409: подію з цим id уже записала попередня спроба, втратилась лише відповідь
+            if isinstance(e, HttpError) and e.resp.status == 409:
+                print(f"[CREATED] {m.summary} (already stored by an earlier attempt)")
+                created += 1
+            else:
+                print(f"[ERROR] Insert failed for {m.summary}: {e}")
+                errors.append(m.summary)
+            continue
+        print(f"[CREATED] {m.summary} → {res.get('htmlLink','')}")
         created += 1
+
+    if errors:
+        raise RuntimeError(f"Created {created} events, {len(errors)} insert(s) failed: {', '.join(errors)}")
     return created
 
 def main():
@@ -209,7 +371,8 @@ def main():
         raise RuntimeError("GOOGLE_CREDENTIALS_JSON env var is missing.")
     info = json.loads(creds_json)
     creds = Credentials.from_service_account_info(info, scopes=["https://www.googleapis.com/auth/calendar"])
-    service = build("calendar", "v3", credentials=creds, cache_discovery=False)
+    # discovery-документ calendar v3 береться з копії, вбудованої в google-api-python-client, без HTTP-запиту
+    service = build("calendar", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
 
     print(f"[CHECK] Source: bo3.gg (Playwright); TZ={TIMEZONE}")
     print(f"[CHECK] Filters: LOOKAHEAD_DAYS={LOOKAHEAD_DAYS}, PAST_GRACE_MINUTES={PAST_GRACE_MINUTES}")